@@ -1,10 +1,17 @@
 """
-Database module for managing endpoint data using TOML files.
+Database module for managing endpoint data in a SQLite database.
 """
 
 # standard library
-import uuid
+import contextlib
+import json
 import os
+import sqlite3
+import threading
+import time
+import tomllib
+import uuid
+import weakref
 from typing import Dict, Any, List, Optional
 
 # pypi
@@ -13,15 +20,78 @@ import toml
 
 def generate_endpoint_id():
     """
-    Generates a unique endpoint ID using UUID4.
+    Generates a unique endpoint ID using UUID4, as 32 hex digits without dashes.
     """
     # We should check for collisions in a real implementation
-    return str(uuid.uuid4())
+    return uuid.uuid4().hex
+
+
+def generate_task_id():
+    """
+    Generates a task ID for server-created tasks, as 32 hex digits without dashes.
+    Task IDs are opaque strings; clients may pick their own format.
+    """
+    return uuid.uuid4().hex
+
+
+# Idle connections kept for reuse after the threads that opened them exit. Each live
+# thread holds one connection of its own regardless of this limit.
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 2 * (os.cpu_count() or 1)))
+
+# Distinguishes a missing task field from one explicitly set to None.
+_MISSING = object()
+
+# Endpoint records and tasks are stored as JSON; the indexed columns are copies of the
+# fields that lookups filter on. tasks.seq (the rowid) preserves assignment order.
+# Tasks refer to their endpoint by its integer endpoints.seq rather than its ID string,
+# which keeps the task index small; endpoint IDs only appear in the endpoints table.
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS endpoints (
+        seq INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        hostname TEXT,
+        ip_address TEXT,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS endpoints_by_host ON endpoints (hostname, ip_address)",
+    """CREATE TABLE IF NOT EXISTS tasks (
+        seq INTEGER PRIMARY KEY,
+        endpoint_seq INTEGER NOT NULL REFERENCES endpoints (seq),
+        task_id TEXT NOT NULL,
+        responded INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL,
+        UNIQUE (endpoint_seq, task_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (endpoint_seq, responded)",
+)
+# Stored in PRAGMA user_version. 0 is the first SQLite layout, where tasks referred to
+# endpoints by ID string. It was an internal intermediate layout that never shipped in a
+# release; _migrate only upgrades databases written by development builds that had it.
+_SCHEMA_VERSION = 1
+
+
+class _ConnectionLease:
+    """A thread's claim on a pooled connection, released when the thread's locals go."""
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
 
 
 class EndpointDatabase:
     """
-    Database class for managing endpoint data stored in TOML files.
+    Database class for managing endpoint data stored in SQLite (data/endpoints.db).
+
+    Endpoints stored by older versions as per-endpoint JSON/TOML files in data/ are
+    imported on startup and the files moved to data/legacy/.
+
+    Thread safety: one instance is meant to be shared by every thread in a process
+    (server.py keeps it in a module global). Each thread works on its own pooled
+    connection, so reads take no Python lock at all; the only lock guards the idle
+    connection list, and is held only when a thread leases its first connection or
+    exits. Writes are serialized by SQLite itself, per transaction (BEGIN IMMEDIATE),
+    which also covers other processes using the same file.
     """
 
     # Allowed fields for tasks, other keys will get stripped out when saving task data to ensure a consistent schema.
@@ -48,148 +118,475 @@ class EndpointDatabase:
         "stderr": "",
         "stopped_processing_at": "",
         "responded": False,
-        "inventory": {},
+        # None rather than {} so sanitized tasks never share one mutable dict.
+        "inventory": None,
     }
 
+    # How often wait_for_change checks whether another process has committed.
+    _CHANGE_POLL_INTERVAL = 0.25
+
+    # Older SQLite builds allow at most 999 bound parameters per statement.
+    _MAX_QUERY_PARAMS = 900
+
+    # Inserts nothing if the endpoint ID is unknown or the endpoint already has a task
+    # with this ID: re-posting a task ID must not wipe out a result that came back.
+    _INSERT_TASK = (
+        "INSERT INTO tasks (endpoint_seq, task_id, responded, data) "
+        "SELECT seq, ?, ?, ? FROM endpoints WHERE id = ? "
+        "ON CONFLICT (endpoint_seq, task_id) DO NOTHING"
+    )
+
     def __init__(self):
         self.base_path = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), "data"
         )
         os.makedirs(self.base_path, exist_ok=True)
+        self.db_path = os.path.join(self.base_path, "endpoints.db")
+        # A connection is used by one thread at a time: each thread leases its own from
+        # the idle pool (or opens one) and returns it when the thread exits.
+        self._local = threading.local()
+        self._idle: List[sqlite3.Connection] = []
+        self._idle_lock = threading.Lock()
+        # Set on every write made through this instance; see wait_for_change.
+        self._changed = threading.Event()
+        conn = self._conn()
+        # WAL lets readers (request threads, the TUI) run alongside a writer.
+        conn.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        self._import_legacy_files()
+
+    def _migrate(self):
+        """Creates the schema, or brings a database written by an older version up to date."""
+        with self._transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+                return
+            legacy = conn.execute(
+                "SELECT 1 FROM pragma_table_info('tasks') WHERE name = 'endpoint_id'"
+            ).fetchone()
+            if legacy:
+                conn.execute("DROP INDEX endpoints_by_host")
+                conn.execute("DROP INDEX tasks_by_state")
+                conn.execute("ALTER TABLE tasks RENAME TO tasks_v0")
+                conn.execute("ALTER TABLE endpoints RENAME TO endpoints_v0")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            if legacy:
+                conn.execute(
+                    "INSERT INTO endpoints (seq, id, hostname, ip_address, data) "
+                    "SELECT rowid, id, hostname, ip_address, data FROM endpoints_v0 "
+                    "ORDER BY rowid"
+                )
+                conn.execute(
+                    "INSERT INTO tasks (seq, endpoint_seq, task_id, responded, data) "
+                    "SELECT tasks_v0.seq, endpoints.seq, tasks_v0.task_id, "
+                    "tasks_v0.responded, tasks_v0.data FROM tasks_v0 "
+                    "JOIN endpoints ON endpoints.id = tasks_v0.endpoint_id"
+                )
+                conn.execute("DROP TABLE tasks_v0")
+                conn.execute("DROP TABLE endpoints_v0")
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _conn(self):
+        """Returns this thread's connection, leasing it on first use."""
+        lease = getattr(self._local, "lease", None)
+        if lease is None:
+            lease = self._local.lease = _ConnectionLease(self._checkout())
+            weakref.finalize(lease, self._checkin, lease.conn).atexit = False
+        return lease.conn
+
+    def _checkout(self):
+        """Takes an idle connection from the pool, or opens a new one."""
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop()
+        # isolation_level=None: statements autocommit unless wrapped in _transaction().
+        # check_same_thread=False: pooled connections move between threads, though
+        # only ever one thread uses a connection at a time.
+        conn = sqlite3.connect(
+            self.db_path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        # In WAL mode NORMAL only syncs at checkpoints, not on every commit.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _checkin(self, conn):
+        """Returns a connection whose thread has exited to the pool, or closes it."""
+        with self._idle_lock:
+            if len(self._idle) < DB_POOL_MAX:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Runs the block in a write transaction on this thread's connection."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._changed.set()
+
+    def _data_version(self):
+        """Returns a counter that moves whenever another connection commits."""
+        return self._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def wait_for_change(self, timeout):
+        """
+        Blocks until the database changes or timeout seconds pass, returning True if it
+        changed. Writes from this instance wake the caller at once; commits from other
+        connections and processes (e.g. the server, when called from the TUI) are noticed
+        within _CHANGE_POLL_INTERVAL. Changes are tracked per thread since its last call,
+        so a commit between that call and this one is not missed.
+        """
+        seen = getattr(self._local, "seen_version", None)
+        if seen is None:
+            seen = self._local.seen_version = self._data_version()
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self._data_version()
+            if version != seen:
+                self._local.seen_version = version
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._changed.wait(min(remaining, self._CHANGE_POLL_INTERVAL)):
+                self._changed.clear()
+                self._local.seen_version = self._data_version()
+                return True
 
-    def _path_for_id(self, endpoint_id):
-        """Returns the canonical TOML file path for a given endpoint ID."""
-        filename = str(endpoint_id)
-        if not filename.endswith(".toml"):
-            filename = f"{filename}.toml"
-        return os.path.join(self.base_path, filename)
-
-    def _legacy_path_for_id(self, endpoint_id):
-        """Returns the legacy file path without the .toml suffix."""
-        return os.path.join(self.base_path, str(endpoint_id))
+    @staticmethod
+    def _dumps(value):
+        """Serializes value as compact JSON."""
+        # Compact separators keep json on its C encoder; indent= falls back to pure Python.
+        return json.dumps(value, separators=(",", ":"), default=str)
 
     def save_endpoint(self, endpoint_id, data):
-        """Saves endpoint data to a TOML file."""
-        path = self._path_for_id(endpoint_id)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(toml.dumps(data))
-        legacy_path = self._legacy_path_for_id(endpoint_id)
-        if legacy_path != path and os.path.exists(legacy_path):
-            os.remove(legacy_path)
+        """
+        Saves endpoint data.
+
+        Tasks are stored separately and changed through add_task and post_task_result,
+        so any "tasks" key is ignored. data itself is not modified.
+        """
+        record = {key: value for key, value in data.items() if key != "tasks"}
+        self._conn().execute(
+            "INSERT INTO endpoints (id, hostname, ip_address, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET hostname = excluded.hostname, "
+            "ip_address = excluded.ip_address, data = excluded.data",
+            (
+                str(endpoint_id),
+                record.get("hostname"),
+                record.get("ip_address"),
+                self._dumps(record),
+            ),
+        )
+        self._changed.set()
+
+    def bulk_update_last_seen(self, last_seen_by_id):
+        """Sets last_seen for many endpoints (id -> timestamp) in one transaction."""
+        if not last_seen_by_id:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE endpoints SET data = json_set(data, '$.last_seen', ?) "
+                "WHERE id = ?",
+                [
+                    (last_seen, str(endpoint_id))
+                    for endpoint_id, last_seen in last_seen_by_id.items()
+                ],
+            )
+
+    def find_endpoints(self, hostname, ip_address):
+        """Returns the IDs of all endpoints registered with this hostname and IP."""
+        rows = self._conn().execute(
+            "SELECT id FROM endpoints WHERE hostname IS ? AND ip_address IS ? "
+            "ORDER BY id",
+            (hostname, ip_address),
+        )
+        return [row[0] for row in rows]
 
     def endpoint_exists(self, endpoint_id):
         """
-        Checks if an endpoint exists by verifying the presence of its TOML file.
+        Checks if an endpoint exists.
 
         :param self: The instance of the class.
         :param endpoint_id: The unique identifier for the endpoint.
         """
-        canonical = self._path_for_id(endpoint_id)
-        if os.path.exists(canonical):
-            return True
-        legacy = self._legacy_path_for_id(endpoint_id)
-        return os.path.exists(legacy)
+        row = (
+            self._conn()
+            .execute("SELECT 1 FROM endpoints WHERE id = ?", (str(endpoint_id),))
+            .fetchone()
+        )
+        return row is not None
 
     def list_endpoints(self):
         """Lists all registered endpoint IDs."""
-        all_files = os.listdir(self.base_path)
-        endpoints = []
-        for filename in all_files:
-            stem = filename[:-5] if filename.endswith(".toml") else filename
-            try:
-                uuid.UUID(stem)
-            except ValueError:
-                continue
-            endpoints.append(stem)
-        return endpoints
+        rows = self._conn().execute("SELECT id FROM endpoints ORDER BY seq")
+        return [row[0] for row in rows]
 
     def get_endpoint(self, endpoint_id):
-        """Retrieves endpoint data from its TOML file."""
-
-        canonical = self._path_for_id(endpoint_id)
-        if os.path.exists(canonical):
-            path = canonical
-        else:
-            legacy = self._legacy_path_for_id(endpoint_id)
-            if not os.path.exists(legacy):
-                return None
-            path = legacy
-
-        with open(path, "r", encoding="utf-8") as f:
-            try:
-                data = toml.load(f)
-            except toml.TomlDecodeError:
+        """Retrieves endpoint data, including its full task list."""
+        data = self._load_record(endpoint_id)
+        if data is None:
+            return None
+        rows = self._conn().execute(
+            "SELECT tasks.data FROM endpoints "
+            "JOIN tasks ON tasks.endpoint_seq = endpoints.seq "
+            "WHERE endpoints.id = ? ORDER BY tasks.seq",
+            (str(endpoint_id),),
+        )
+        data["tasks"] = [json.loads(row[0]) for row in rows]
+        return data
+
+    def get_assigned_tasks(
+        self, assignments: Dict[str, str]
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Looks up one task per endpoint for an endpoint_id -> task_id mapping. Returns
+        endpoint_id -> task, with None for a task the endpoint doesn't have; unknown
+        endpoints are left out.
+        """
+        pairs = [
+            (str(endpoint_id), task_id) for endpoint_id, task_id in assignments.items()
+        ]
+        conn = self._conn()
+        found: Dict[str, Optional[Dict[str, Any]]] = {}
+        step = self._MAX_QUERY_PARAMS // 2
+        for start in range(0, len(pairs), step):
+            chunk = pairs[start : start + step]
+            values = ",".join("(?, ?)" for _ in chunk)
+            params = [value for pair in chunk for value in pair]
+            rows = conn.execute(
+                f"WITH wanted (endpoint_id, task_id) AS (VALUES {values}) "
+                "SELECT wanted.endpoint_id, tasks.data FROM wanted "
+                "JOIN endpoints ON endpoints.id = wanted.endpoint_id "
+                "LEFT JOIN tasks ON tasks.endpoint_seq = endpoints.seq "
+                "AND tasks.task_id = wanted.task_id",
+                params,
+            )
+            for endpoint_id, data in rows:
+                found[endpoint_id] = json.loads(data) if data is not None else None
+        return found
+
+    def _load_record(self, endpoint_id):
+        """Returns the stored endpoint record without its tasks, or None if missing."""
+        row = (
+            self._conn()
+            .execute("SELECT data FROM endpoints WHERE id = ?", (str(endpoint_id),))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _insert_task(self, conn, endpoint_id, task):
+        """
+        Inserts a sanitized task. Returns False, inserting nothing, if the endpoint is
+        unknown or already has a task with the same ID.
+        """
+        cursor = conn.execute(
+            self._INSERT_TASK,
+            (
+                task["task_id"],
+                1 if task.get("responded") else 0,
+                self._dumps(task),
+                str(endpoint_id),
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def _import_legacy_files(self):
+        """
+        Imports endpoints that older versions stored as files in data/ (<id>.json with an
+        optional <id>.tasks.ndjson log, <id>.toml, or a suffix-less TOML file), then moves
+        those files to data/legacy/. Endpoints already in the database are not overwritten.
+        """
+        files: Dict[str, List[str]] = {}
+        with os.scandir(self.base_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stem = entry.name
+                for suffix in (".tasks.ndjson", ".json", ".toml"):
+                    if stem.endswith(suffix):
+                        stem = stem[: -len(suffix)]
+                        break
+                try:
+                    uuid.UUID(stem)
+                except ValueError:
+                    continue
+                files.setdefault(stem, []).append(entry.name)
+        if not files:
+            return
+
+        legacy_dir = os.path.join(self.base_path, "legacy")
+        os.makedirs(legacy_dir, exist_ok=True)
+        for endpoint_id, names in files.items():
+            data = self._read_legacy_endpoint(endpoint_id, names)
+            if data is None:
                 print(
-                    f"Warning: Failed to parse TOML for endpoint {endpoint_id} at {path}"
+                    f"Warning: Failed to import legacy files for endpoint {endpoint_id}"
                 )
-                return None
+                continue
+            with self._transaction() as conn:
+                if not self.endpoint_exists(endpoint_id):
+                    self.save_endpoint(endpoint_id, data)
+                    for task in data["tasks"]:
+                        self._insert_task(conn, endpoint_id, task)
+            for name in names:
+                try:
+                    os.replace(
+                        os.path.join(self.base_path, name),
+                        os.path.join(legacy_dir, name),
+                    )
+                except FileNotFoundError:
+                    # Another process imported it first.
+                    pass
+
+    def _read_legacy_endpoint(self, endpoint_id, names):
+        """Reads one endpoint's legacy files into a record with a normalized task list."""
+        data = None
+        for name in (f"{endpoint_id}.json", f"{endpoint_id}.toml", endpoint_id):
+            if name in names:
+                with open(os.path.join(self.base_path, name), encoding="utf-8") as f:
+                    content = f.read()
+                if name.endswith(".json"):
+                    data = self._parse_json(content)
+                else:
+                    data = self._parse_legacy_toml(content)
+                break
+        if data is None:
+            return None
 
-        # Normalize task objects so downstream callers always get the expected schema.
         self._normalize_endpoint_tasks(data)
+        tasks = {task["task_id"]: task for task in data["tasks"]}
+        log_name = f"{endpoint_id}.tasks.ndjson"
+        if log_name in names:
+            with open(os.path.join(self.base_path, log_name), encoding="utf-8") as f:
+                tasks.update(self._parse_task_log(f.read()))
+        data["tasks"] = list(tasks.values())
+        return data
 
-        if path != canonical:
-            # Promote legacy files to the canonical naming scheme.
-            self.save_endpoint(endpoint_id, data)
+    @staticmethod
+    def _parse_json(content):
+        """Parses a legacy JSON endpoint file, returning None if it is malformed."""
+        try:
+            return json.loads(content)
+        except ValueError:
+            return None
 
-        return data
+    @staticmethod
+    def _parse_legacy_toml(content):
+        """Parses a legacy TOML endpoint file, returning None if it is malformed."""
+        try:
+            return tomllib.loads(content)
+        except tomllib.TOMLDecodeError:
+            pass
+        # tomllib is stricter than the toml package that wrote older files; retry with it.
+        try:
+            return toml.loads(content)
+        except toml.TomlDecodeError:
+            return None
+
+    @staticmethod
+    def _parse_task_log(content):
+        """
+        Folds a legacy task log into an ordered task_id -> task dict. Later lines for a
+        task_id are partial updates merged over the earlier entry.
+        """
+        tasks: Dict[str, Dict[str, Any]] = {}
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Blank or torn line left by an interrupted append.
+                continue
+            task_id = entry.get("task_id")
+            if task_id in tasks:
+                tasks[task_id].update(entry)
+            elif task_id:
+                tasks[task_id] = entry
+        return tasks
 
     def ensure_non_duplicate(self, new_endpoint_id, new_info):
         """Returns True if no other endpoint has the same hostname and IP."""
-        new_hostname = new_info.get("hostname")
-        nip = new_info.get("ip_address")
-
-        for eid in self.list_endpoints():
-            if eid == new_endpoint_id:
-                continue
-            data = self.get_endpoint(eid)
-            if data is None:
-                continue
-            if data.get("hostname") == new_hostname and data.get("ip_address") == nip:
-                return False
-        return True
+        row = (
+            self._conn()
+            .execute(
+                "SELECT 1 FROM endpoints WHERE hostname IS ? AND ip_address IS ? "
+                "AND id <> ? LIMIT 1",
+                (
+                    new_info.get("hostname"),
+                    new_info.get("ip_address"),
+                    str(new_endpoint_id),
+                ),
+            )
+            .fetchone()
+        )
+        return row is None
 
     def register_endpoint(self, agent_id, info):
-        """Registers a new endpoint if it is not a duplicate."""
-        if not self.ensure_non_duplicate(agent_id, info):
-            return False
-
-        # Ensure task list exists in stored data.
-        if "tasks" not in info:
-            info["tasks"] = []
-
-        self.save_endpoint(agent_id, info)
+        """Registers a new endpoint if it is not a duplicate. info is not modified."""
+        with self._transaction():
+            if not self.ensure_non_duplicate(agent_id, info):
+                return False
+            self.save_endpoint(agent_id, info)
         return True
 
     def get_cert_fingerprint(self, agent_id):
         """Returns the stored SHA-256 cert fingerprint for an endpoint, or None."""
-        data = self.get_endpoint(agent_id)
-        if data is None:
+        record = self._load_record(agent_id)
+        if record is None:
             return None
-        return data.get("cert_fingerprint")
+        return record.get("cert_fingerprint")
+
+    def get_cert_state(self, agent_id):
+        """
+        Returns (cert_fingerprint, blacklisted) for an endpoint in one lookup, or None
+        if the endpoint does not exist. Only those two fields are read from the record.
+        """
+        row = (
+            self._conn()
+            .execute(
+                "SELECT json_extract(data, '$.cert_fingerprint'), "
+                "json_extract(data, '$.blacklisted') FROM endpoints WHERE id = ?",
+                (str(agent_id),),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return row[0], bool(row[1])
 
     def set_cert_fingerprint(self, agent_id, fingerprint):
         """Stores the SHA-256 cert fingerprint for an endpoint."""
-        data = self.get_endpoint(agent_id)
-        if data is None:
-            return False
-        data["cert_fingerprint"] = fingerprint
-        self.save_endpoint(agent_id, data)
+        with self._transaction():
+            record = self._load_record(agent_id)
+            if record is None:
+                return False
+            record["cert_fingerprint"] = fingerprint
+            self.save_endpoint(agent_id, record)
         return True
 
     def is_blacklisted(self, agent_id):
         """Returns True if the endpoint is blacklisted."""
-        data = self.get_endpoint(agent_id)
-        if data is None:
+        record = self._load_record(agent_id)
+        if record is None:
             return False
-        return bool(data.get("blacklisted", False))
+        return bool(record.get("blacklisted", False))
 
     def blacklist_endpoint(self, agent_id):
         """Marks an endpoint as blacklisted."""
-        data = self.get_endpoint(agent_id)
-        if data is None:
-            return False
-        data["blacklisted"] = True
-        self.save_endpoint(agent_id, data)
+        with self._transaction():
+            record = self._load_record(agent_id)
+            if record is None:
+                return False
+            record["blacklisted"] = True
+            self.save_endpoint(agent_id, record)
         return True
 
     def add_task(self, endpoint_id, task):
@@ -200,18 +597,79 @@ class EndpointDatabase:
         :param endpoint_id: The unique identifier for the endpoint.
         :param task: The task to be added.
         """
-        data = self.get_endpoint(endpoint_id)
-        if data is None:
-            return False
-        if "tasks" not in data:
-            data["tasks"] = []
+        return self.add_tasks(endpoint_id, [task])
+
+    def add_tasks(self, endpoint_id, tasks):
+        """
+        Adds several tasks to the specified endpoint's task list in one transaction.
+        Nothing is added if the endpoint is unknown, any task is missing its ID, or any
+        task ID is already in use on the endpoint.
+
+        :param self: The instance of the class.
+        :param endpoint_id: The unique identifier for the endpoint.
+        :param tasks: The tasks to be added, in assignment order.
+        """
         try:
-            sanitized_task = self._sanitize_task(task, responded=False)
+            sanitized = [self._sanitize_task(task, responded=False) for task in tasks]
         except ValueError:
             return False
-        data["tasks"].append(sanitized_task)
-        self.save_endpoint(endpoint_id, data)
-        return True
+        with self._transaction() as conn:
+            if not self.endpoint_exists(endpoint_id):
+                return False
+            conn.execute("SAVEPOINT endpoint_tasks")
+            added = all(
+                self._insert_task(conn, endpoint_id, task) for task in sanitized
+            )
+            if not added:
+                conn.execute("ROLLBACK TO endpoint_tasks")
+            conn.execute("RELEASE endpoint_tasks")
+        return added
+
+    def add_tasks_bulk(self, grouped_tasks):
+        """
+        Adds tasks for several endpoints in one transaction, with one existence query
+        however many endpoints are involved. Each task succeeds or fails on its own, as
+        if it had been passed to add_task separately and in order.
+
+        :param self: The instance of the class.
+        :param grouped_tasks: Mapping of endpoint ID -> tasks, in assignment order.
+        :return: Mapping of endpoint ID -> one outcome per task, in the same order:
+            True if the task was added, False if it is missing its ID or reuses a task
+            ID already on the endpoint, or None if the endpoint is unknown.
+        """
+        outcome: Dict[str, List[Any]] = {}
+        sanitized: Dict[str, List[Any]] = {}
+        for endpoint_id, tasks in grouped_tasks.items():
+            cleaned = []
+            for task in tasks:
+                try:
+                    cleaned.append(self._sanitize_task(task, responded=False))
+                except ValueError:
+                    cleaned.append(None)
+            sanitized[str(endpoint_id)] = cleaned
+        ids = list(sanitized)
+        with self._transaction() as conn:
+            known = set()
+            for start in range(0, len(ids), self._MAX_QUERY_PARAMS):
+                chunk = ids[start : start + self._MAX_QUERY_PARAMS]
+                marks = ",".join("?" * len(chunk))
+                known.update(
+                    row[0]
+                    for row in conn.execute(
+                        f"SELECT id FROM endpoints WHERE id IN ({marks})", chunk
+                    )
+                )
+            for endpoint_id in ids:
+                tasks = sanitized[endpoint_id]
+                if endpoint_id not in known:
+                    outcome[endpoint_id] = [None] * len(tasks)
+                    continue
+                # A duplicate task ID inserts nothing, so the other tasks are unaffected.
+                outcome[endpoint_id] = [
+                    task is not None and self._insert_task(conn, endpoint_id, task)
+                    for task in tasks
+                ]
+        return outcome
 
     def post_task_result(self, endpoint_id, tdata):
         """
@@ -222,10 +680,6 @@ class EndpointDatabase:
         :param task_id: The unique identifier for the task.
         :param result: The result of the task.
         """
-        data = self.get_endpoint(endpoint_id)
-        if data is None:
-            return False
-
         try:
             sanitized_result = self._sanitize_task(tdata, responded=True)
         except ValueError:
@@ -235,28 +689,27 @@ class EndpointDatabase:
         provided_fields = set(tdata.keys())
         provided_fields.discard("task_id")
 
-        updated = False
-        for task in data.get("tasks", []):
-            # Handle legacy tasks that might still use "id" as the identifier.
-            if task.get("task_id") is None and task.get("id") == task_id:
-                task["task_id"] = task.pop("id")
-
-            if task.get("task_id") == task_id:
-                for key, value in sanitized_result.items():
-                    if key == "task_id":
-                        continue
-                    if key == "responded" or key in provided_fields:
-                        task[key] = value
-                updated = True
-                break
-        else:
-            return False  # Task ID not found
-
-        # Remove legacy top-level entries that stored task results separately.
-        if isinstance(data.get(task_id), dict):
-            data.pop(task_id, None)
-
-        self.save_endpoint(endpoint_id, data)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT tasks.data FROM endpoints "
+                "JOIN tasks ON tasks.endpoint_seq = endpoints.seq "
+                "WHERE endpoints.id = ? AND tasks.task_id = ?",
+                (str(endpoint_id), task_id),
+            ).fetchone()
+            if row is None:
+                return False  # Unknown endpoint or task ID
+
+            task = json.loads(row[0])
+            for key, value in sanitized_result.items():
+                if key == "task_id":
+                    continue
+                if key == "responded" or key in provided_fields:
+                    task[key] = value
+            conn.execute(
+                "UPDATE tasks SET responded = 1, data = ? WHERE task_id = ? "
+                "AND endpoint_seq = (SELECT seq FROM endpoints WHERE id = ?)",
+                (self._dumps(task), task_id, str(endpoint_id)),
+            )
         return True
 
     def get_tasks_for_endpoint(self, endpoint_id):
@@ -266,13 +719,21 @@ class EndpointDatabase:
         :param self: The instance of the class.
         :param endpoint_id: The unique identifier for the endpoint.
         """
-        data = self.get_endpoint(endpoint_id)
-        if data is None:
+        # One query answers both "does the endpoint exist" and "what is pending": an
+        # endpoint with no pending tasks yields a single row with a NULL task.
+        rows = (
+            self._conn()
+            .execute(
+                "SELECT tasks.data FROM endpoints LEFT JOIN tasks "
+                "ON tasks.endpoint_seq = endpoints.seq AND tasks.responded = 0 "
+                "WHERE endpoints.id = ? ORDER BY tasks.seq",
+                (str(endpoint_id),),
+            )
+            .fetchall()
+        )
+        if not rows:
             return None
-        tasks = data.get("tasks", [])
-        if not isinstance(tasks, list):
-            return []
-        return [task for task in tasks if not task.get("responded", False)]
+        return [json.loads(row[0]) for row in rows if row[0] is not None]
 
     def _sanitize_task(
         self, task: Dict[str, Any], *, responded: Optional[bool] = None
@@ -281,20 +742,18 @@ class EndpointDatabase:
         if not isinstance(task, dict):
             raise ValueError("task must be a dictionary")
 
-        sanitized: Dict[str, Any] = {}
         task_id = task.get("task_id") or task.get("id")
         if not task_id:
             raise ValueError("task is missing task_id")
-        sanitized["task_id"] = task_id
+        sanitized: Dict[str, Any] = {"task_id": task_id}
 
+        # One pass over the schema, taking each field from the task or its default.
+        defaults = self._TASK_DEFAULTS
         for field in self._TASK_FIELDS:
             if field == "task_id":
                 continue
-            if field in task:
-                sanitized[field] = task[field]
-
-        for field, default in self._TASK_DEFAULTS.items():
-            sanitized.setdefault(field, default)
+            value = task.get(field, _MISSING)
+            sanitized[field] = defaults.get(field) if value is _MISSING else value
 
         if responded is not None:
             sanitized["responded"] = responded
@@ -10,16 +10,18 @@ Features:
 from __future__ import annotations
 
 import argparse
+import base64
 import json
+import os
 import sys
-import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Mapping
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from InquirerPy import inquirer
@@ -54,6 +56,7 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 from database import EndpointDatabase
+from util import get_current_timestamp
 
 console = Console()
 
@@ -63,14 +66,19 @@ DEFAULT_CERT = str(PROJECT_ROOT / "certs" / "operator.crt")
 DEFAULT_KEY = str(PROJECT_ROOT / "certs" / "operator.key")
 DEFAULT_CA_CERT = str(PROJECT_ROOT / "certs" / "ca.crt")
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
-def current_timestamp() -> str:
-    """Return current UTC time in ISO 8601 format with trailing Z."""
-    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
-
-def new_task_id() -> str:
-    return str(uuid.uuid4())
+def new_task_ids(count: int) -> List[str]:
+    """
+    Return count random task IDs, drawing all the randomness in one call. Each is 128
+    bits as 22 URL-safe base64 characters.
+    """
+    raw = os.urandom(16 * count)
+    return [
+        base64.urlsafe_b64encode(raw[offset : offset + 16]).rstrip(b"=").decode("ascii")
+        for offset in range(0, 16 * count, 16)
+    ]
 
 
 @dataclass(frozen=True)
@@ -93,27 +101,118 @@ class TaskBuilder:
     arg: str | None
     task_id: str | None = None
 
-    def build(self) -> Dict[str, Any]:
-        """Return a task payload that conforms to backend/STRUCTS.md."""
-        payload = {
-            "task_id": self.task_id or new_task_id(),
-            "assigned_at": current_timestamp(),
+    def template(self) -> Dict[str, Any]:
+        """Return the payload fields shared by every task this builder makes."""
+        return {
             "instruction": self.instruction,
             "arg": self.arg if self.arg is not None else "",
         }
-        return payload
+
+    def build(self) -> Dict[str, Any]:
+        """Return a task payload that conforms to backend/STRUCTS.md."""
+        return self.build_many(1)[0]
+
+    def build_many(self, count: int) -> List[Dict[str, Any]]:
+        """
+        Return count task payloads for one fan-out. They share a timestamp and, unless
+        this builder has a fixed task_id, draw their IDs from a single urandom read.
+        """
+        template = self.template()
+        assigned_at = get_current_timestamp()
+        if self.task_id:
+            task_ids = [self.task_id] * count
+        else:
+            task_ids = new_task_ids(count)
+        return [
+            {"task_id": task_id, "assigned_at": assigned_at, **template}
+            for task_id in task_ids
+        ]
+
+
+def make_session(cert: tuple[str, str], ca_cert: str) -> requests.Session:
+    """Return a session that reuses keep-alive TLS connections to the management API.
+
+    Failed connection attempts are retried with a short backoff; a POST that
+    reached the server is never replayed.
+    """
+    session = requests.Session()
+    session.cert = cert
+    session.verify = ca_cert
+    retries = Retry(total=3, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _post(session: requests.Session, url: str, data: bytes) -> Response:
+    # verify/cert are passed per request: requests lets REQUESTS_CA_BUNDLE and
+    # CURL_CA_BUNDLE override the session's values, which would drop the pinned CA.
+    return session.post(
+        url,
+        data=data,
+        headers=_JSON_HEADERS,
+        timeout=15,
+        verify=session.verify,
+        cert=session.cert,
+    )
 
 
 def post_task(
+    session: requests.Session,
     url: str,
     agent_id: str,
     task_payload: Dict[str, Any],
-    *,
-    cert: tuple[str, str],
-    ca_cert: str,
 ) -> Response:
     body = {"agentid": agent_id, "task": task_payload}
-    return requests.post(url, json=body, timeout=15, cert=cert, verify=ca_cert)
+    # Encode compactly ourselves; requests' json= uses the default ", " / ": " separators.
+    data = json.dumps(body, separators=(",", ":")).encode("utf-8")
+    return _post(session, url, data)
+
+
+def bulk_url_for(url: str) -> str | None:
+    """Return the bulk post_tasks URL alongside a post_task URL, if url is one."""
+    if url.endswith("/post_task"):
+        return url + "s"
+    return None
+
+
+def post_tasks(
+    session: requests.Session,
+    url: str,
+    prepared: List[tuple[str, Dict[str, Any]]],
+) -> Response:
+    body = {
+        "assignments": [
+            {"agentid": agent_id, "task": payload} for agent_id, payload in prepared
+        ]
+    }
+    data = json.dumps(body, separators=(",", ":")).encode("utf-8")
+    return _post(session, url, data)
+
+
+def report_bulk_response(
+    prepared: List[tuple[str, Dict[str, Any]]], response: Response
+) -> None:
+    """Print the per-endpoint outcome of a post_tasks request."""
+    if response.status_code != 200:
+        content = response.text.strip() or "no response body"
+        for agent_id, _ in prepared:
+            console.print(
+                f"[red]Task rejected for {agent_id}: {response.status_code} — {content}[/red]"
+            )
+        return
+
+    results = response.json()["results"]
+    for (agent_id, payload), result in zip(prepared, results):
+        if result["status"] != "success":
+            console.print(
+                f"[red]Task rejected for {agent_id}: {result['status']}[/red]"
+            )
+            continue
+        console.print(
+            f"[green]Queued task {payload['task_id']} for endpoint {agent_id}.[/green]"
+        )
 
 
 def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
@@ -141,7 +240,7 @@ def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
     )
     parser.add_argument(
         "--task-id",
-        help="Optional task UUID. When targeting multiple endpoints a UUID is generated per endpoint.",
+        help="Optional task ID. When targeting multiple endpoints an ID is generated per endpoint.",
     )
     parser.add_argument(
         "--url",
@@ -273,44 +372,79 @@ def dispatch_tasks(
     agent_ids: Iterable[str],
     builder: TaskBuilder,
     *,
+    session: requests.Session,
     url: str,
     print_payload: bool,
-    cert: tuple[str, str],
-    ca_cert: str,
 ) -> Dict[str, str]:
     """Queue the task for each endpoint and return mapping of agent_id -> task_id."""
+    agent_ids = list(agent_ids)
     assignments: Dict[str, str] = {}
-    for agent_id in agent_ids:
-        payload = builder.build()
+    prepared: List[tuple[str, Dict[str, Any]]] = []
+
+    # The assignments are effectively simultaneous, so they share one timestamp too.
+    for agent_id, payload in zip(agent_ids, builder.build_many(len(agent_ids))):
         assignments[agent_id] = payload["task_id"]
+        prepared.append((agent_id, payload))
 
         if print_payload:
-            console.print(
-                Panel.fit(
-                    json.dumps({"agentid": agent_id, "task": payload}, indent=2),
-                    title=f"Payload for {agent_id}",
-                    border_style="blue",
+            body = {"agentid": agent_id, "task": payload}
+            if console.is_terminal:
+                console.print(
+                    Panel.fit(
+                        json.dumps(body, indent=2),
+                        title=f"Payload for {agent_id}",
+                        border_style="blue",
+                    )
                 )
-            )
+            else:
+                # Piped or redirected output: one compact JSON line, no Rich layout.
+                sys.stdout.write(json.dumps(body, separators=(",", ":")) + "\n")
 
+    if not prepared:
+        return assignments
+
+    # Several endpoints: queue everything in one request when the server supports it.
+    bulk_url = bulk_url_for(url) if len(prepared) > 1 else None
+    if bulk_url:
         try:
-            response = post_task(url, agent_id, payload, cert=cert, ca_cert=ca_cert)
+            response = post_tasks(session, bulk_url, prepared)
         except requests.RequestException as exc:
-            console.print(
-                f"[red]Failed to connect to management API for {agent_id}: {exc}[/red]"
+            console.print(f"[red]Failed to connect to management API: {exc}[/red]")
+            return assignments
+        # Servers without the bulk endpoint get one request per endpoint instead.
+        if response.status_code != 404:
+            report_bulk_response(prepared, response)
+            return assignments
+
+    # Post concurrently; results are reported from this thread as they complete.
+    with ThreadPoolExecutor(max_workers=min(32, len(prepared))) as executor:
+        futures = {
+            executor.submit(post_task, session, url, agent_id, payload): (
+                agent_id,
+                payload,
             )
-            continue
+            for agent_id, payload in prepared
+        }
+        for future in as_completed(futures):
+            agent_id, payload = futures[future]
+            try:
+                response = future.result()
+            except requests.RequestException as exc:
+                console.print(
+                    f"[red]Failed to connect to management API for {agent_id}: {exc}[/red]"
+                )
+                continue
+
+            if response.status_code != 200:
+                content = response.text.strip() or "no response body"
+                console.print(
+                    f"[red]Task rejected for {agent_id}: {response.status_code} — {content}[/red]"
+                )
+                continue
 
-        if response.status_code != 200:
-            content = response.text.strip() or "no response body"
             console.print(
-                f"[red]Task rejected for {agent_id}: {response.status_code} — {content}[/red]"
+                f"[green]Queued task {payload['task_id']} for endpoint {agent_id}.[/green]"
             )
-            continue
-
-        console.print(
-            f"[green]Queued task {payload['task_id']} for endpoint {agent_id}.[/green]"
-        )
 
     return assignments
 
@@ -331,7 +465,8 @@ def summarize_task_state(task: Mapping[str, Any]) -> tuple[Text, str, str, str]:
         else:
             status = Text(f"Failed ({exit_code})", style="red")
 
-    stdout = task.get("stdout") or str(task.get("inventory")) or ""
+    inventory = task.get("inventory")
+    stdout = task.get("stdout") or (str(inventory) if inventory else "")
     stderr = task.get("stderr") or ""
     if stderr and not stdout:
         stdout = f"[stderr] {stderr}"
@@ -340,6 +475,30 @@ def summarize_task_state(task: Mapping[str, Any]) -> tuple[Text, str, str, str]:
     return status, str(exit_code) if exit_code is not None else "-", snippet, stopped_at
 
 
+# Row states for monitor_tasks when there is no task record to show.
+_MISSING_ENDPOINT = "missing-endpoint"
+_AWAITING_QUEUE = "awaiting-queue"
+
+
+def build_task_row(agent_id: str, task_id: str, state: Any) -> tuple[Any, ...]:
+    """Return the dashboard cells for one endpoint's task (or missing-record state)."""
+    if state is _MISSING_ENDPOINT:
+        return (
+            agent_id,
+            task_id,
+            Text("Missing endpoint record", style="red"),
+            "-",
+            "-",
+            "",
+        )
+    if state is _AWAITING_QUEUE:
+        return (agent_id, task_id, Text("Awaiting queue", style="yellow"), "-", "-", "")
+
+    status, exit_code, snippet, stopped_at = summarize_task_state(state)
+    last_update = stopped_at or state.get("assigned_at") or "-"
+    return (agent_id, task_id, status, exit_code, last_update, snippet)
+
+
 def monitor_tasks(
     db: EndpointDatabase,
     assignments: Dict[str, str],
@@ -359,69 +518,53 @@ def monitor_tasks(
         )
     )
 
-    with Live(console=console, refresh_per_second=4) as live:
+    # Repaint only when a monitored task actually changed, not on a timer. Rows are
+    # cached per agent with the state they were built from, and only rebuilt when
+    # that state changes.
+    row_cache: Dict[str, tuple[Any, tuple[Any, ...]]] = {}
+    with Live(console=console, auto_refresh=False) as live:
         try:
             while True:
-                table = Table(title="Endpoint task state", expand=True)
-                table.add_column("Endpoint", style="bold cyan")
-                table.add_column("Task ID")
-                table.add_column("Status")
-                table.add_column("Exit Code")
-                table.add_column("Last Update")
-                table.add_column("Output Preview")
-
                 all_done = True
+                changed = False
 
-                for agent_id, task_id in assignments.items():
-                    endpoint_data = db.get_endpoint(agent_id)
-                    if endpoint_data is None:
-                        table.add_row(
-                            agent_id,
-                            task_id,
-                            Text("Missing endpoint record", style="red"),
-                            "-",
-                            "-",
-                            "",
-                        )
-                        continue
+                # Look up every assigned task in one batch per tick.
+                snapshot = db.get_assigned_tasks(assignments)
 
-                    tasks = endpoint_data.get("tasks", [])
-                    task = next(
-                        (item for item in tasks if item.get("task_id") == task_id),
-                        None,
-                    )
-
-                    if task is None:
-                        table.add_row(
-                            agent_id,
-                            task_id,
-                            Text("Awaiting queue", style="yellow"),
-                            "-",
-                            "-",
-                            "",
+                for agent_id, task_id in assignments.items():
+                    if agent_id not in snapshot:
+                        state: Any = _MISSING_ENDPOINT
+                    else:
+                        state = snapshot[agent_id]
+                        if state is None:
+                            state = _AWAITING_QUEUE
+                        if state is _AWAITING_QUEUE or not state.get("responded"):
+                            all_done = False
+
+                    cached = row_cache.get(agent_id)
+                    if cached is None or cached[0] != state:
+                        row_cache[agent_id] = (
+                            state,
+                            build_task_row(agent_id, task_id, state),
                         )
-                        all_done = False
-                        continue
-
-                    status, exit_code, snippet, stopped_at = summarize_task_state(task)
-                    if not task.get("responded"):
-                        all_done = False
-
-                    last_update = stopped_at or task.get("assigned_at") or "-"
-                    table.add_row(
-                        agent_id,
-                        task_id,
-                        status,
-                        exit_code,
-                        last_update,
-                        snippet,
-                    )
-
-                live.update(table)
+                        changed = True
+
+                if changed:
+                    table = Table(title="Endpoint task state", expand=True)
+                    table.add_column("Endpoint", style="bold cyan")
+                    table.add_column("Task ID")
+                    table.add_column("Status")
+                    table.add_column("Exit Code")
+                    table.add_column("Last Update")
+                    table.add_column("Output Preview")
+                    for agent_id in assignments:
+                        table.add_row(*row_cache[agent_id][1])
+                    live.update(table, refresh=True)
 
                 if all_done:
                     break
-                time.sleep(max(poll_interval, 0.5))
+                # Re-check as soon as something is committed, or after poll_interval.
+                db.wait_for_change(max(poll_interval, 0.5))
         except KeyboardInterrupt:
             console.print("\n[yellow]Stopped monitoring at user request.[/yellow]")
 
@@ -444,14 +587,17 @@ def main(argv: List[str] | None = None) -> int:
 
     builder = TaskBuilder(instruction=instruction, arg=arg, task_id=task_id)
 
-    assignments = dispatch_tasks(
-        agent_ids,
-        builder,
-        url=args.url,
-        print_payload=args.print_payload,
-        cert=(args.cert, args.key),
-        ca_cert=args.ca_cert,
-    )
+    session = make_session((args.cert, args.key), args.ca_cert)
+    try:
+        assignments = dispatch_tasks(
+            agent_ids,
+            builder,
+            session=session,
+            url=args.url,
+            print_payload=args.print_payload,
+        )
+    finally:
+        session.close()
 
     if not args.no_monitor:
         monitor_tasks(db, assignments, args.poll_interval)
@@ -3,13 +3,16 @@ Backend flask app for handling endpoint check-ins and task results.
 """
 
 # standard library
+import atexit
+import hashlib
 import ipaddress
 import logging
 import os
+import socket
 import ssl
 import threading
 import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # pypi
 import toml
@@ -17,14 +20,15 @@ from dotenv import load_dotenv
 
 load_dotenv()
 from apiflask import APIFlask, Schema
-from apiflask.fields import String, Integer, Boolean, Dict, Raw
+from apiflask.fields import String, Integer, Boolean, Dict, List, Nested, Raw
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 from cryptography.x509.oid import NameOID
 from flask import Flask as PlainFlask
-from flask import jsonify, request
+from flask import Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from marshmallow import INCLUDE
-from werkzeug.serving import make_server
+from werkzeug.serving import BaseWSGIServer
 
 from certs import (
     CA_CERT_PATH,
@@ -37,8 +41,13 @@ from certs import (
     generate_client_cert,
     MTLSRequestHandler,
 )
-from database import EndpointDatabase, generate_endpoint_id
-from util import get_current_timestamp, primitive_log
+from database import EndpointDatabase, generate_endpoint_id, generate_task_id
+from util import (
+    TTLCache,
+    get_current_timestamp,
+    primitive_log,
+    start_queued_logging,
+)
 
 log = logging.getLogger(__name__)
 
@@ -49,6 +58,35 @@ CRON_CONFIG_PATH = os.path.join(
 CRON_MIN_INTERVAL = 5
 CRON_DEFAULT_INTERVAL = 30
 
+# How long checkin may serve an agent's pending task list without re-reading it.
+# Every path that changes an agent's tasks in this process invalidates its entry.
+CHECKIN_CACHE_TTL = 2.0
+# Upper bound on agents held in each lookup cache; least recently used are evicted.
+CACHE_MAX_ENTRIES = 10_000
+
+# When positive, a checkin that finds no tasks waits up to this many seconds for one to
+# be queued before answering 204. A waiting checkin occupies a server worker, so keep
+# SERVER_WORKERS above the number of agents polling at once. Off (0) by default.
+CHECKIN_LONG_POLL = float(os.environ.get("CHECKIN_LONG_POLL", "0"))
+
+# Larger request bodies are refused with 413 before they are read or parsed. Task
+# results carry command output, so this is generous.
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# Checkins buffer last_seen in memory; it is written to the database this often,
+# or as soon as this many agents are waiting to be written.
+LAST_SEEN_FLUSH_INTERVAL = 2.0
+LAST_SEEN_FLUSH_MAX_PENDING = 500
+# Checkins closer together than this (seconds) don't update last_seen again.
+LAST_SEEN_MIN_INTERVAL = 1.0
+
+_last_seen_pending = {}
+# agent_id -> time.monotonic() of the last recorded checkin.
+_last_seen_marks = {}
+_last_seen_lock = threading.Lock()
+# Set by checkin to wake the flush worker before LAST_SEEN_FLUSH_INTERVAL is up.
+_last_seen_full = threading.Event()
+
 _cron_state = {"interval": CRON_DEFAULT_INTERVAL, "page_refresh_interval": 10}
 _cron_lock = threading.Lock()
 
@@ -111,12 +149,13 @@ def _cron_worker():
                 )
                 if not has_pending:
                     task = {
-                        "task_id": str(uuid.uuid4()),
+                        "task_id": generate_task_id(),
                         "assigned_at": get_current_timestamp(),
                         "instruction": "inventory",
                         "arg": None,
                     }
                     db.add_task(agent_id, task)
+                    _tasks_queued(agent_id)
                     log.debug("Cron: queued inventory for agent %s", agent_id)
         except Exception:
             log.exception("Cron worker encountered an error")
@@ -124,12 +163,87 @@ def _cron_worker():
         time.sleep(interval)
 
 
+def _flush_last_seen():
+    """Write all buffered last_seen timestamps to the database in one transaction."""
+    global _last_seen_pending
+    with _last_seen_lock:
+        pending, _last_seen_pending = _last_seen_pending, {}
+    if pending:
+        db.bulk_update_last_seen(pending)
+
+
+def _last_seen_worker():
+    """Background thread: periodically flushes the checkin last_seen buffer."""
+    while True:
+        _last_seen_full.wait(LAST_SEEN_FLUSH_INTERVAL)
+        _last_seen_full.clear()
+        try:
+            _flush_last_seen()
+        except Exception:
+            log.exception("last_seen flush failed")
+
+
 # ---------------------------------------------------------------------------
 # Main app (mTLS, port 8443)
 # ---------------------------------------------------------------------------
 
+
+class CompactJSONProvider(DefaultJSONProvider):
+    """
+    Skips key sorting and indentation when encoding responses; keys keep the order
+    they are stored in, and compact output stays on json's C encoder.
+    """
+
+    sort_keys = False
+    compact = True
+
+
 app = APIFlask(__name__)
+app.json = CompactJSONProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
 db = EndpointDatabase()
+_pending_tasks_cache = TTLCache(CHECKIN_CACHE_TTL, maxsize=CACHE_MAX_ENTRIES)
+# agent_id -> (cert_fingerprint, blacklisted) for verify_client_cert; invalidated
+# whenever this process blacklists an agent.
+_cert_state_cache = TTLCache(CHECKIN_CACHE_TTL, maxsize=CACHE_MAX_ENTRIES)
+
+
+def _load_pending_tasks(agent_id):
+    """Loads the agent's unanswered tasks and their ETag, or None for an unknown agent."""
+    tasks = db.get_tasks_for_endpoint(agent_id)
+    if tasks is None:
+        return None
+    digest = hashlib.blake2b(app.json.dumps(tasks).encode(), digest_size=12)
+    return tasks, digest.hexdigest()
+
+
+def _get_pending_tasks(agent_id):
+    """
+    Returns (tasks, etag) for the agent's unanswered tasks (cached), or None for an
+    unknown agent. The ETag changes whenever any pending task does.
+    """
+    return _pending_tasks_cache.get_or_load(agent_id, _load_pending_tasks)
+
+
+# agent_id -> Event that long-polling checkins for the agent wait on. Queuing a task
+# removes and sets it, so each round of waiters gets a fresh one.
+_task_events = {}
+_task_events_lock = threading.Lock()
+
+
+def _task_event(agent_id):
+    """Returns the Event a long-polling checkin for agent_id should wait on."""
+    with _task_events_lock:
+        return _task_events.setdefault(agent_id, threading.Event())
+
+
+def _tasks_queued(agent_id):
+    """Drops the agent's cached task list and wakes its long-polling checkins."""
+    _pending_tasks_cache.invalidate(agent_id)
+    with _task_events_lock:
+        event = _task_events.pop(agent_id, None)
+    if event is not None:
+        event.set()
 
 
 @app.before_request
@@ -151,16 +265,20 @@ def verify_client_cert():
     except Exception:
         return jsonify({"error": "invalid certificate"}), 401
 
-    if db.is_blacklisted(agent_id):
+    # One lookup for both pinning checks; unknown agents are neither blacklisted nor
+    # enrolled.
+    cert_state = _cert_state_cache.get_or_load(agent_id, db.get_cert_state)
+    stored_fp, blacklisted = cert_state or (None, False)
+    if blacklisted:
         return jsonify({"error": "agent blacklisted"}), 403
 
-    stored_fp = db.get_cert_fingerprint(agent_id)
     if stored_fp is None:
         return jsonify({"error": "agent not enrolled"}), 401
 
     presented_fp = cert_fingerprint(cert_der)
     if presented_fp != stored_fp:
         db.blacklist_endpoint(agent_id)
+        _cert_state_cache.invalidate(agent_id)
         log.warning("Cert mismatch for agent %s — blacklisted", agent_id)
         return jsonify({"error": "certificate mismatch — agent blacklisted"}), 403
 
@@ -212,6 +330,10 @@ class TaskSchema(Schema):
     )
 
 
+# Shared instance for the checkin output, built once rather than per route.
+_task_list_schema = TaskSchema(many=True)
+
+
 class PostResultSchema(TaskSchema):
     agent_id = String(
         required=True,
@@ -257,27 +379,49 @@ class StatusSchema(Schema):
 
 
 # START ENDPOINT ROUTES
-@app.post("/api/end/checkin")
+@app.route("/api/end/checkin", methods=["GET", "POST"])
 @app.input(CheckinQuerySchema, location="query")
 @app.output(
-    TaskSchema(many=True), status_code=200, description="Queued tasks for the endpoint."
+    _task_list_schema, status_code=200, description="Queued tasks for the endpoint."
 )
 def checkin(query_data):
-    """Check in an endpoint and retrieve any queued tasks."""
+    """
+    Check in an endpoint and retrieve any queued tasks. Task lists carry an ETag; a GET
+    checkin sending it back in If-None-Match gets 304 while the list is unchanged.
+    With CHECKIN_LONG_POLL set, an empty list is held back until a task is queued
+    or the long-poll timeout passes.
+    """
     agentid = query_data["agentid"]
-    endpoint = db.get_endpoint(agentid)
-
-    if endpoint is None:
+    pending = _get_pending_tasks(agentid)
+    if pending is None:
         return "unknown agentid", 404
-
-    last_seen = get_current_timestamp()
-    endpoint["last_seen"] = last_seen
-    db.save_endpoint(agentid, endpoint)
-
-    tasks = db.get_tasks_for_endpoint(agentid)
-    if tasks:
-        return tasks
-    return "no tasks", 204
+    tasks, etag = pending
+
+    # An agent checking in again within LAST_SEEN_MIN_INTERVAL (retry storms, buggy
+    # clients) doesn't need a fresher last_seen.
+    now = time.monotonic()
+    with _last_seen_lock:
+        last_mark = _last_seen_marks.get(agentid)
+        if last_mark is None or now - last_mark >= LAST_SEEN_MIN_INTERVAL:
+            _last_seen_marks[agentid] = now
+            _last_seen_pending[agentid] = get_current_timestamp()
+            if len(_last_seen_pending) >= LAST_SEEN_FLUSH_MAX_PENDING:
+                _last_seen_full.set()
+
+    if not tasks and CHECKIN_LONG_POLL > 0:
+        # Only known agents get an Event. Reading again after taking it means a task
+        # queued since the first read (which drops the cached list) is not missed.
+        event = _task_event(agentid)
+        tasks, etag = _get_pending_tasks(agentid) or ([], None)
+        if not tasks and event.wait(CHECKIN_LONG_POLL):
+            tasks, etag = _get_pending_tasks(agentid) or ([], None)
+    if not tasks:
+        return "no tasks", 204
+    headers = {"ETag": f'"{etag}"'}
+    # 304 is only defined for GET (and HEAD); a POST checkin always gets the body.
+    if request.method == "GET" and request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    return tasks, 200, headers
 
 
 @app.post("/api/end/post_result")
@@ -289,25 +433,18 @@ def checkin(query_data):
 )
 def post_result(json_data):
     """Submit the outcome of a task that has been executed by an endpoint."""
-    data = dict(json_data)
-    agentid = data.pop("agent_id", None) or data.pop("agentid", None)
-    if not agentid:
-        primitive_log(
-            "FLASK - Post Results",
-            "Missing agent identifier in post_result payload. Content: " + str(data),
-        )
-        return "missing parameters", 400
-
-    task_id = data.get("task_id") or data.get("id")
-    if not task_id:
+    # PostResultSchema requires agent_id and task_id, so both are present here. The
+    # payload is passed as is: the database keeps only known task fields.
+    agentid = json_data["agent_id"]
+    success = db.post_task_result(agentid, json_data)
+    _pending_tasks_cache.invalidate(agentid)
+    if not success:
         primitive_log(
             "FLASK - Post Results",
-            "Missing task identifier in post_result payload. Content: " + str(data),
+            "No task %s for agent %s; result dropped.",
+            json_data["task_id"],
+            agentid,
         )
-        return "missing parameters", 400
-
-    success = db.post_task_result(agentid, data)
-    if not success:
         return "failed to post result", 400
 
     return {"status": "result posted"}, 200
@@ -322,28 +459,35 @@ def register_endpoint(json_data):
     """Register a new endpoint and obtain its assigned agent identifier."""
     remote_addr = request.remote_addr
     now = get_current_timestamp()
-    payload = dict(json_data)
-
-    app.logger.info(
-        "Incoming %s request to %s from %s with payload %s",
-        request.method,
-        request.path,
-        remote_addr,
-        payload,
-    )
+    # json_data is a fresh dict from schema loading and isn't used elsewhere, so it is
+    # updated in place rather than copied.
+    payload = json_data
 
     hostname = payload.get("hostname")
+    # The queue handler formats records on this thread, so the full payload is only
+    # rendered when debug logging is on.
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(
+            "Incoming %s request to %s from %s with payload %s",
+            request.method,
+            request.path,
+            remote_addr,
+            payload,
+        )
+    else:
+        app.logger.info(
+            "Incoming %s request to %s from %s (hostname %s)",
+            request.method,
+            request.path,
+            remote_addr,
+            hostname,
+        )
     agent_id = None
 
     if hostname:
-        for existing_id in db.list_endpoints():
+        for existing_id in db.find_endpoints(hostname, remote_addr):
             existing_data = db.get_endpoint(existing_id)
-            if not existing_data:
-                continue
-            if (
-                existing_data.get("hostname") == hostname
-                and existing_data.get("ip_address") == remote_addr
-            ):
+            if existing_data:
                 agent_id = existing_id
                 existing_data.update(
                     {key: value for key, value in payload.items() if key != "tasks"}
@@ -394,16 +538,85 @@ def post_task(json_data):
     # TODO: maintain a canonical list of valid instructions and return 400 for unknown ones.
     # Should mirror the cases in endpoint/task_utils.go: syscall, exit, inventory, install_av, av_scan.
 
-    endpoint = db.get_endpoint(agent_id)
-    if endpoint is None:
+    if not db.endpoint_exists(agent_id):
         return "unknown agentid", 404
 
     res = db.add_task(agent_id, task_payload)
+    _tasks_queued(agent_id)
     if not res:
         return "failed to add task", 400
     return {"status": "success"}, 200
 
 
+class BulkPostTaskSchema(Schema):
+    assignments = List(
+        Nested(PostTaskSchema),
+        required=True,
+        metadata={"description": "Tasks to queue, each for one agent."},
+    )
+
+
+class BulkPostTaskResultSchema(Schema):
+    agentid = String(metadata={"description": "Agent the task was meant for."})
+    task_id = String(metadata={"description": "Identifier of the task, if given."})
+    status = String(
+        metadata={
+            "description": 'Outcome for this task: "success", "unknown agentid" or '
+            '"failed to add task".'
+        }
+    )
+
+
+class BulkPostTaskResponseSchema(Schema):
+    results = List(
+        Nested(BulkPostTaskResultSchema),
+        metadata={"description": "One result per assignment, in request order."},
+    )
+
+
+_BULK_STATUS = {
+    True: "success",
+    False: "failed to add task",
+    None: "unknown agentid",
+}
+
+
+@app.post("/api/man/post_tasks")
+@app.input(BulkPostTaskSchema)
+@app.output(
+    BulkPostTaskResponseSchema,
+    status_code=200,
+    description="Per-assignment outcome of queuing the tasks.",
+)
+def post_tasks(json_data):
+    """Create tasks for several agents in one request."""
+    assignments = json_data["assignments"]
+
+    # Group by agent and queue everything in a single transaction.
+    grouped = {}
+    for assignment in assignments:
+        grouped.setdefault(assignment["agentid"], []).append(assignment["task"])
+
+    outcome = db.add_tasks_bulk(grouped)
+    for agent_id in grouped:
+        _tasks_queued(agent_id)
+    # Each agent's outcomes are in the same order as its assignments.
+    pending = {agent_id: iter(added) for agent_id, added in outcome.items()}
+    statuses = [
+        _BULK_STATUS[next(pending[assignment["agentid"]])] for assignment in assignments
+    ]
+
+    results = [
+        {
+            "agentid": assignment["agentid"],
+            "task_id": assignment["task"].get("task_id"),
+            "status": status,
+        }
+        for assignment, status in zip(assignments, statuses)
+    ]
+    return {"results": results}, 200
+
+
 class CronConfigSchema(Schema):
     inventory_interval = Integer(
         required=True,
@@ -453,6 +666,20 @@ def update_cron(json_data):
     return {"inventory_interval": inv, "page_refresh_interval": refresh}, 200
 
 
+@app.get("/api/man/cache_stats")
+def cache_stats():
+    """Report size and hit/miss counters for the server's lookup caches."""
+    return (
+        jsonify(
+            {
+                "pending_tasks": _pending_tasks_cache.stats(),
+                "cert_state": _cert_state_cache.stats(),
+            }
+        ),
+        200,
+    )
+
+
 @app.get("/api/man/agents")
 def list_agents():
     """List all registered agents with their metadata."""
@@ -481,6 +708,8 @@ def get_agent(agent_id):
 # ---------------------------------------------------------------------------
 
 enroll_app = PlainFlask(__name__ + ".enroll")
+enroll_app.json = CompactJSONProvider(enroll_app)
+enroll_app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
 
 
 @enroll_app.post("/api/enroll")
@@ -489,21 +718,16 @@ def enroll():
     One-shot unauthenticated endpoint.  Issues a CA-signed client cert and
     registers the agent.  Subsequent communication must use mTLS with this cert.
     """
-    data = request.get_json(force=True) or {}
+    # Parsed exactly once here; nothing else on this route reads the body again.
+    data = request.get_json(force=True, cache=False) or {}
     hostname = data.get("hostname", "unknown")
     ip_address = request.remote_addr
     now = get_current_timestamp()
 
     # Reject if this host is already enrolled (same hostname + IP with a stored cert).
-    for existing_id in db.list_endpoints():
+    for existing_id in db.find_endpoints(hostname, ip_address):
         existing_data = db.get_endpoint(existing_id)
-        if not existing_data:
-            continue
-        if (
-            existing_data.get("hostname") == hostname
-            and existing_data.get("ip_address") == ip_address
-            and existing_data.get("cert_fingerprint")
-        ):
+        if existing_data and existing_data.get("cert_fingerprint"):
             return jsonify({"error": "already enrolled, use existing cert"}), 409
 
     agent_id = generate_endpoint_id()
@@ -548,12 +772,97 @@ def enroll():
     )
 
 
+# ---------------------------------------------------------------------------
+# WSGI server
+# ---------------------------------------------------------------------------
+
+# Worker threads per server; override with SERVER_WORKERS in .env.
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "32"))
+# Seconds a connection may sit without sending its request before it is dropped; a
+# connection occupies a worker for as long as it is open.
+SERVER_SOCKET_TIMEOUT = float(os.environ.get("SERVER_SOCKET_TIMEOUT", "15"))
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that handles connections on a fixed pool of worker threads
+    rather than a new thread per connection. Load beyond the pool queues instead of
+    spawning threads without limit, and each worker keeps its database connection
+    across requests.
+
+    Sockets get TCP_NODELAY, since werkzeug writes headers and body separately and
+    Nagle's algorithm would hold the second write back, and a read timeout of
+    socket_timeout seconds so a stalled or silent client can't hold a worker
+    indefinitely. (werkzeug closes every connection after one response, so there is
+    no keep-alive to tune.) With TLS, the handshake runs in the worker under the same
+    timeout, so the accept loop never waits on a peer.
+    """
+
+    multithread = True
+    # Room for a burst of agents reconnecting at once, e.g. after a restart.
+    request_queue_size = 1024
+
+    def __init__(self, *args, max_workers, socket_timeout, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._socket_timeout = socket_timeout
+        self.RequestHandlerClass = type(
+            self.RequestHandlerClass.__name__,
+            (self.RequestHandlerClass,),
+            {"timeout": socket_timeout, "disable_nagle_algorithm": True},
+        )
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"wsgi-{self.port}"
+        )
+
+    def get_request(self):
+        if not isinstance(self.socket, ssl.SSLSocket):
+            return super().get_request()
+        # SSLSocket.accept would run the handshake right here, on the serve_forever
+        # thread and without a timeout; accept plain TCP and defer it to the worker.
+        conn, client_address = socket.socket.accept(self.socket)
+        conn.settimeout(self._socket_timeout)
+        conn = self.socket.context.wrap_socket(
+            conn,
+            server_side=True,
+            do_handshake_on_connect=False,
+            suppress_ragged_eofs=self.socket.suppress_ragged_eofs,
+        )
+        return conn, client_address
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        # Same steps as socketserver.ThreadingMixIn.process_request_thread.
+        try:
+            if isinstance(request, ssl.SSLSocket):
+                try:
+                    request.do_handshake()
+                except OSError:
+                    # Failed or timed-out handshakes were dropped silently when
+                    # accept ran them; keep it that way.
+                    return
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
 # ---------------------------------------------------------------------------
 # Entry point
 # ---------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+    # Log through a queue so request threads don't block on console I/O.
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().setLevel(logging.INFO)
+    start_queued_logging(logging.getLogger(), _log_handler)
 
     _ca_cert, _ca_key = ensure_ca_exists()
     ensure_server_cert_exists(_ca_cert, _ca_key)
@@ -567,23 +876,39 @@ if __name__ == "__main__":
     threading.Thread(target=_cron_worker, daemon=True).start()
     log.info("Cron worker started (inventory interval: %ds)", _cron_state["interval"])
 
+    threading.Thread(target=_last_seen_worker, daemon=True).start()
+    atexit.register(_flush_last_seen)
+
     ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_ctx.load_cert_chain(SERVER_CERT_PATH, SERVER_KEY_PATH)
     ssl_ctx.verify_mode = ssl.CERT_REQUIRED
     ssl_ctx.load_verify_locations(CA_CERT_PATH)
 
+    # Both servers handle requests on bounded worker pools, so one slow agent doesn't
+    # stall every other checkin. The database keeps a connection per worker thread.
+
     # Enrollment server — plain HTTP, daemon thread
-    enroll_server = make_server("0.0.0.0", 8080, enroll_app)
+    enroll_server = PooledWSGIServer(
+        "0.0.0.0",
+        8080,
+        enroll_app,
+        max_workers=SERVER_WORKERS,
+        socket_timeout=SERVER_SOCKET_TIMEOUT,
+    )
     threading.Thread(target=enroll_server.serve_forever, daemon=True).start()
     log.info("Enrollment server listening on http://0.0.0.0:8080")
 
     # mTLS server — blocking main thread
-    mtls_server = make_server(
+    mtls_server = PooledWSGIServer(
         "0.0.0.0",
         8443,
         app,
+        handler=MTLSRequestHandler,
         ssl_context=ssl_ctx,
-        request_handler=MTLSRequestHandler,
+        max_workers=SERVER_WORKERS,
+        socket_timeout=SERVER_SOCKET_TIMEOUT,
+    )
+    log.info(
+        "mTLS server listening on https://0.0.0.0:8443 (%d workers)", SERVER_WORKERS
     )
-    log.info("mTLS server listening on https://0.0.0.0:8443")
     mtls_server.serve_forever()
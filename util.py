@@ -2,17 +2,209 @@
 Place to put random stuff that isn't strictly database related
 """
 
-from datetime import datetime, UTC
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
 
 
-def primitive_log(who, something):
-    with open("db.log", "a+") as f:
-        f.write(who + " : " + something + "\n")
+def start_queued_logging(logger, *handlers):
+    """
+    Routes logger's records through a queue to handlers, which run on a listener
+    thread so the logging thread never waits on I/O. Returns the started listener.
+    """
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+_db_log = logging.getLogger("db.log")
+_db_log.setLevel(logging.INFO)
+_db_log.propagate = False
+# db.log and its listener thread are set up on the first primitive_log call, so
+# importing util (e.g. from the TUI, for timestamps) doesn't create either.
+_db_log_started = False
+_db_log_lock = threading.Lock()
+
+
+def _start_db_log():
+    global _db_log_started
+    with _db_log_lock:
+        if _db_log_started:
+            return
+        handler = logging.FileHandler("db.log", delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        start_queued_logging(_db_log, handler)
+        _db_log_started = True
+
+
+def primitive_log(who, something, *args):
+    """
+    Appends "who : something" to db.log. something may be a %-format string for
+    args, which is only formatted if the line is actually logged.
+    """
+    if not _db_log_started:
+        _start_db_log()
+    _db_log.info(who + " : " + something, *args)
+
+
+# (tick, timestamp) for the most recent 100ms tick, and (second, "YYYY-MM-DDTHH:MM:SS")
+# for the most recent whole second; each is replaced as a whole, so readers on other
+# threads always see a matching pair.
+_timestamp_cache = (-1, "")
+_timestamp_prefix = (-1, "")
 
 
 def get_current_timestamp():
     """
-    Returns current UTC time in ISO format with Z suffix.
+    Returns current UTC time in ISO format with Z suffix. Calls within the same 100ms
+    tick share one formatted value, and ticks within the same second only format the
+    fractional part.
+    """
+    global _timestamp_cache, _timestamp_prefix
+    now = time.time()
+    tick = int(now * 10)
+    cached_tick, cached = _timestamp_cache
+    if tick == cached_tick:
+        return cached
+    second = int(now)
+    cached_second, prefix = _timestamp_prefix
+    if second != cached_second:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        _timestamp_prefix = (second, prefix)
+    timestamp = f"{prefix}.{int((now - second) * 1_000_000):06d}Z"
+    _timestamp_cache = (tick, timestamp)
+    return timestamp
+
+
+# Marks a cache miss; distinct from any cached value, including None.
+_MISS = object()
+
+
+class _Flight:
+    """One in-progress TTLCache load that concurrent callers for the same key join."""
+
+    __slots__ = ("done", "value", "error", "invalidated")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.invalidated = False
+
+
+class TTLCache:
+    """
+    Small thread-safe key -> value cache whose entries expire ttl seconds after
+    they are set. With maxsize, the least recently used entry is evicted once the
+    cache is full. Callers must invalidate keys whose underlying data changes.
     """
-    current_utc_aware = datetime.now(UTC)
-    return current_utc_aware.isoformat().replace("+00:00", "Z")
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Returns the live value for key or _MISS, counting either. Needs _lock held."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISS
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            self.misses += 1
+            return _MISS
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _store(self, key, value):
+        """Caches value for key, evicting the oldest entry if full. Needs _lock held."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing or expired."""
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISS else value
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, or loads it with loader(key) and caches the
+        result unless it is None. Concurrent misses on the same key share one loader
+        call: the first caller runs it and the others wait for its result.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISS:
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader(key)
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                if (
+                    flight.error is None
+                    and flight.value is not None
+                    and not flight.invalidated
+                ):
+                    self._store(key, flight.value)
+            flight.done.set()
+        return flight.value
+
+    def set(self, key, value):
+        """Caches value for key for the next ttl seconds."""
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """
+        Drops key from the cache, if present. A load already running for key still
+        answers its callers but isn't cached, and later callers start a fresh load.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            flight = self._inflight.pop(key, None)
+            if flight is not None:
+                flight.invalidated = True
+
+    def stats(self):
+        """Returns the current size, bound and hit/miss counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }